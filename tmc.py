@@ -2,21 +2,60 @@
 import argparse
 from collections import namedtuple
 from concurrent.futures import ThreadPoolExecutor
-import jmespath
+import functools
 import json
 import os
-import requests
+import string
 import sys
+import tempfile
 import textwrap
+import threading
 import time
 
-EX = ThreadPoolExecutor(max_workers=5)
+try:
+    import orjson
 
-color = namedtuple('color', 'red green yellow blue bold endc none')(*[
-    lambda s, u=c: '\033[%sm%s\033[0m' % (u, s)
-    if (sys.platform != 'win32' and u != '') else s
-    for c in '91,92,93,94,1,0,'.split(',')
-])
+    def loads(s):
+        return orjson.loads(s)
+
+    def dumps(data, indent=False):
+        return orjson.dumps(
+            data, option=orjson.OPT_INDENT_2 if indent else 0
+        )
+
+except ImportError:
+    def loads(s):
+        return json.loads(s)
+
+    def dumps(data, indent=False):
+        return json.dumps(
+            data, indent=2 if indent else None, ensure_ascii=False,
+            separators=None if indent else (',', ':')
+        ).encode()
+
+DEBUG = os.environ.get('TMC_DEBUG') == 'TRUE'
+POOL_SIZE = 16
+
+_EXECUTOR = None
+_SESSION = None
+_JMES_CACHE = {}
+_TOKEN_CACHE = {}
+_TOKEN_LOCK = threading.Lock()
+
+Color = namedtuple('color', 'red green yellow blue bold endc none')
+if sys.platform == 'win32':
+    color = Color(*[lambda s: s] * len(Color._fields))
+else:
+    color = Color(*[
+        (lambda s, u=c: f'\033[{u}m{s}\033[0m') if c != '' else
+        (lambda s: s)
+        for c in '91,92,93,94,1,0,'.split(',')
+    ])
+
+# length of each colour's escape codes, which ljust counts but don't display
+_ANSI_LEN = {_: len(_('')) for _ in color}
+_BAR = ' %s ' % color.blue('|')
+_PLUS = ' %s ' % color.blue('+')
 
 
 PDQ_CONFIG = {
@@ -106,8 +145,53 @@ def fatal(msg):
 
 
 def debug(msg):
-    if os.environ.get('TMC_DEBUG') == 'TRUE':
-        print(color.green('DEBUG: %s' % msg))
+    if DEBUG is True:
+        print(color.green('DEBUG: %s' % (msg() if callable(msg) else msg)))
+
+
+def get_executor():
+    global _EXECUTOR
+    if _EXECUTOR is None:
+        _EXECUTOR = ThreadPoolExecutor(
+            max_workers=POOL_SIZE, thread_name_prefix='tmc'
+        )
+    return _EXECUTOR
+
+
+def get_session():
+    global _SESSION
+    if _SESSION is None:
+        # requests is slow to import so only pay for it when calling the api
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        _SESSION = requests.Session()
+        _SESSION.mount('https://', HTTPAdapter(
+            pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE,
+            max_retries=Retry(
+                total=3, backoff_factor=0.2, raise_on_status=False,
+                status_forcelist=[429, 500, 502, 503, 504]
+            )
+        ))
+        _SESSION.headers['Accept'] = 'application/json'
+    return _SESSION
+
+
+def jmes(expr):
+    compiled = _JMES_CACHE.get(expr)
+    if compiled is None:
+        import jmespath
+        compiled = _JMES_CACHE[expr] = jmespath.compile(expr)
+    return compiled
+
+
+def pmap(fn, items):
+    items = list(items)
+    # a single item isn't worth a thread hop, and waiting on the executor
+    # from one of its own workers can deadlock once the pool is saturated
+    if len(items) < 2 or threading.current_thread().name.startswith('tmc'):
+        return [fn(i) for i in items]
+    return list(get_executor().map(fn, items))
 
 
 def now_secs():
@@ -118,6 +202,11 @@ def delta_secs(start_secs):
     return now_secs() - start_secs
 
 
+@functools.lru_cache(maxsize=None)
+def get_base_url():
+    return 'https://%s.tmc.cloud.vmware.com' % os.environ['TMC_DOMAIN']
+
+
 def get_temp_basedir(base_dir=None):
     default_base_dir = '/tmp'
     if sys.platform == 'win32':
@@ -136,39 +225,94 @@ def get_cache_file(name):
 
 def get_cache(name, raw=False):
     cache_file = get_cache_file(name)
-    # print('cache_file: %s' % cache_file)
-    if os.path.isfile(cache_file):
-        d = read_file(cache_file)
-        if raw is True:
-            return d
-        if now_secs() < d['expires']:
-            return d['data']
+    try:
+        st = os.stat(cache_file)
+    except OSError:
+        return None
+    # mtime is set to the expiry time by write_cache()
+    if raw is not True and now_secs() >= st.st_mtime:
+        return None
+    d = read_file(cache_file)
+    if raw is True:
+        return d
+    if now_secs() < d['expires']:
+        return d['data']
     return None
 
 
 def write_cache(name, data, expire_secs=None):
-    write_file(get_cache_file(name), {
-        'expires': now_secs() + (expire_secs or 60),
+    cache_file = get_cache_file(name)
+    expires = now_secs() + (expire_secs or 60)
+    write_file(cache_file, {
+        'expires': expires,
         'data': data
     }, print_msg=False)
+    os.utime(cache_file, (expires, expires))
 
 
 def read_file(file, print_msg=False):
-    data = json.loads(open(file, 'r').read())
+    with open(file, 'rb') as fh:
+        data = loads(fh.read())
     if print_msg is True:
         print('read %s' % file)
     return data
 
 
 def write_file(file, data, print_msg=False):
-    with open(file, 'w') as fh:
-        fh.write(json.dumps(data, indent=2))
+    fd, tmp_file = tempfile.mkstemp(
+        dir=os.path.dirname(file) or '.',
+        prefix=os.path.basename(file) + '.', suffix='.tmp'
+    )
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(dumps(data, indent=True))
+        os.replace(tmp_file, file)
+    except Exception:
+        try:
+            os.unlink(tmp_file)
+        except OSError:
+            pass
+        raise
     if print_msg is True:
         print('written %s' % file)
 
 
+def set_access_token(access_token, expires):
+    _TOKEN_CACHE['token'] = {'value': access_token, 'expires': expires}
+    get_session().headers['Authorization'] = 'Bearer %s' % access_token
+
+
+def get_access_token(no_cache=False):
+    with _TOKEN_LOCK:
+        token = _TOKEN_CACHE.get('token')
+        if token is not None and now_secs() < token['expires']:
+            return token['value']
+        if token is None and no_cache is False:
+            d = get_cache('token', raw=True)
+            if d is not None and now_secs() < d['expires']:
+                set_access_token(d['data'], d['expires'])
+                return d['data']
+        r = get_session().post(
+            'https://console.cloud.vmware.com/csp/gateway/am'
+            + '/api/auth/api-tokens/authorize',
+            data={'refresh_token': os.environ['TMC_TOKEN']},
+            headers={'Authorization': None}
+        )
+        if r.status_code != 200:
+            fatal('unable to get access_token HTTP %s: %s' % (
+                r.status_code, r.content
+            ))
+        _data = loads(r.content)
+        access_token = _data['access_token']
+        # expire 30s early so a token is never used right at its expiry
+        expires_in = _data['expires_in'] - 30
+        set_access_token(access_token, now_secs() + expires_in)
+        if no_cache is False:
+            write_cache('token', access_token, expires_in)
+        return access_token
+
+
 def api(path, method='GET', **kwargs):
-    kwargs = dict(**kwargs)
     transform = kwargs.pop('transform', None)
     cache = kwargs.pop('cache', None)
     expire_mins = kwargs.pop('expire_mins', None)
@@ -179,7 +323,7 @@ def api(path, method='GET', **kwargs):
     if cache is not None and no_cache is False:
         data = get_cache(cache)
         if data is not None:
-            debug('retrieved %s data from cache' % cache)
+            debug(lambda: 'retrieved %s data from cache' % cache)
             return data
 
     paginate = kwargs.pop('paginate', None)
@@ -191,94 +335,125 @@ def api(path, method='GET', **kwargs):
         if limit < pagination['pagination.size']:
             pagination['pagination.size'] = limit
 
-    # get access_token
-    access_token = None
-    if no_cache is False:
-        access_token = get_cache('token')
-    if access_token is None:
-        r = requests.post(
-            'https://console.cloud.vmware.com/csp/gateway/am'
-            + '/api/auth/api-tokens/authorize',
-            data={'refresh_token': os.environ['TMC_TOKEN']}
-        )
-        if r.status_code != 200:
-            fatal('unable to get access_token HTTP %s: %s' % (
-                r.status_code, r.content
-            ))
-        access_token = r.json()['access_token']
-        if no_cache is False:
-            write_cache('token', access_token, r.json()['expires_in'])
+    # refreshes the session's Authorization header when the token expires
+    get_access_token(no_cache)
 
-    if 'headers' not in kwargs:
-        kwargs['headers'] = {
-            'Authorization': 'Bearer %s' % access_token,
-            'Accept': 'application/json'
-        }
-    url = 'https://%s.tmc.cloud.vmware.com%s' % (
-        os.environ['TMC_DOMAIN'], path
-    )
-    data = []
-    while True:
-        if paginate is not None:
-            if 'params' not in kwargs:
-                kwargs['params'] = {}
-            kwargs['params'].update(pagination)
-        r = requests.Session().request(
-            method.lower(), url, **kwargs
-        )
-        debug('HTTP kwargs: %s' % json.dumps(kwargs, indent=2))
-        debug('HTTP %s %s [%s]' % (method.upper(), url, r.status_code))
+    url = get_base_url() + path
+
+    def _request(params=None):
+        _kwargs = kwargs if params is None else dict(kwargs, params=params)
+        r = get_session().request(method, url, **_kwargs)
+        debug(lambda: 'HTTP kwargs: %s' % dumps(
+            _kwargs, indent=True
+        ).decode())
+        debug(lambda: 'HTTP %s %s [%s]' % (
+            method.upper(), url, r.status_code
+        ))
         if r.status_code not in allowed_codes:
             errmsg = None
             try:
-                errmsg = r.json()['error']
+                errmsg = loads(r.content)['error']
             except Exception:
                 errmsg = r.content
             fatal('HTTP %s %s [%s] %s' % (
                 method, url, r.status_code, errmsg
             ))
-        _data = r.json()
-        if paginate is not None:
-            if paginate not in _data or len(_data[paginate]) == 0:
-                break
-            data.extend(_data[paginate])
-            if str(len(data)) == str(_data.get('totalCount')):
-                break
-            if limit is not None and len(data) >= limit:
-                data = data[0:limit]
-                break
-            pagination['pagination.offset'] = len(data)
-            continue
-        else:
-            data = _data
-        break
+        return loads(r.content)
+
+    if paginate is not None:
+        pagination = dict(kwargs.get('params') or {}, **pagination)
+
+    def _fetch_page(offset):
+        params = pagination
+        if offset > 0:
+            params = dict(pagination)
+            params['pagination.offset'] = offset
+        _data = _request(params)
+        return _data.get(paginate) or [], _data.get('totalCount')
+
+    if paginate is None:
+        data = _request()
+    else:
+        data, total = _fetch_page(0)
+        if total is not None:
+            total = int(total)
+            if limit is not None:
+                total = min(total, limit)
+            # plan offsets from what the server actually returned as it
+            # may cap the page size below the one requested
+            step = len(data)
+            if step > 0:
+                for _items, _ in pmap(_fetch_page, range(step, total, step)):
+                    data.extend(_items)
+                    if len(_items) < step:
+                        break
+        # page serially when there's no totalCount to plan offsets from, or
+        # when a planned page came back short
+        _items = data
+        while len(_items) > 0 and (limit is None or len(data) < limit) and (
+            total is None or len(data) < total
+        ):
+            _items = _fetch_page(len(data))[0]
+            data.extend(_items)
+        if limit is not None:
+            data = data[0:limit]
     if transform is not None:
-        data = jmespath.search(transform, data)
+        data = jmes(transform).search(data)
     if cache is not None and no_cache is False:
-        write_cache(cache, data, expire_mins=expire_mins)
-        debug('written %s data to cache' % cache)
+        write_cache(
+            cache, data, expire_secs=expire_mins * 60 if expire_mins else None
+        )
+        debug(lambda: 'written %s data to cache' % cache)
     return data
 
 
 def api_join(path, name_attrs, join_path, cache=False, entity=None):
     if entity is None:
         entity = path.split('?')[0].split('/')[-1]
-    data = []
+    join_entity = join_path.split('?')[0].split('/')[-1]
+    join_parts = list(string.Formatter().parse(join_path))
+    if not all(
+        field is None or (field.isdigit() and not spec and not conv)
+        for _, field, spec, conv in join_parts
+    ):
+        join_parts = None
+
+    def _join_path(d):
+        if join_parts is None:
+            return join_path.format(*d)
+        _path = []
+        for literal, field, _, _ in join_parts:
+            _path.append(literal)
+            if field is not None:
+                _path.append(str(d[int(field)]))
+        return ''.join(_path)
 
     def _join(d):
-        join_entity = join_path.split('?')[0].split('/')[-1]
-        data.extend(api(
-            join_path.format(*d),
+        return api(
+            _join_path(d),
             transform=join_entity + ' || `[]`',
             allowed_codes=[200, 404],
             cache='%s-%s-%s' % (entity, join_entity, d[0]) if cache else None
-        ))
+        )
 
-    list(EX.map(lambda _: _join(_), api(
-        path,
-        transform='%s[].fullName.[%s]' % (entity, ', '.join(name_attrs)),
-        cache=entity if cache else None
-    )))
+    if all(_.isidentifier() for _ in name_attrs):
+        # plain attribute names so read them directly rather than via jmespath
+        parent = api(path, cache=entity if cache else None)
+        names = [
+            [e['fullName'].get(_) for _ in name_attrs]
+            for e in parent.get(entity) or []
+            if isinstance(e, dict) and isinstance(e.get('fullName'), dict)
+        ]
+    else:
+        names = api(
+            path,
+            transform='%s[].fullName.[%s]' % (entity, ', '.join(name_attrs)),
+            cache=entity if cache else None
+        )
+
+    data = []
+    for _data in pmap(_join, names):
+        data.extend(_data)
     return data
 
 
@@ -289,67 +464,86 @@ def print_table(headers, data, counter=True, sort_key=None, dumpfile=None):
     if not isinstance(data, list) or len(data) == 0:
         print(color.red(' - no data - '))
         return
-    dumpdata = None
+    dumppath = None
     if dumpfile is not None:
-        dumpdata = json.dumps(data, indent=2)
+        # written before rendering so the serialised copy isn't held
+        # alongside the table lines
+        dumppath = os.path.join(get_temp_basedir(), dumpfile)
+        write_file(dumppath, data)
     if sort_key is not None:
         data = sorted(data, key=lambda k: k[sort_key])
-    rc = 0
+    cols = list(headers)
     if counter is True:
         colwidths[' '] = len(str(len(data)))
-        headers.insert(0, ' ')
-    for r in data:
-        rlines = {}
-        linec = 0
-        rc += 1
+        cols.insert(0, ' ')
+
+    def _compile_path(h):
+        if '.' not in h:
+            return lambda r: r.get(h, '')
+        parts = h.split('.')
+        if not all(_.isidentifier() for _ in parts):
+            return jmes(h + ' || ``').search
+
+        def _fetch(r):
+            v = r
+            for k in parts:
+                if not isinstance(v, dict):
+                    return ''
+                v = v.get(k)
+            # same falsiness as jmespath's `||`, where 0 is truthy
+            if v is None or v is False or v in ('', [], {}):
+                return ''
+            return v
+        return _fetch
+
+    getters = [_compile_path(h) for h in headers]
+    for rc, r in enumerate(data, 1):
+        values = [_get(r) for _get in getters]
         if counter is True:
-            r[' '] = str(rc)
-        for h in headers:
-            v = jmespath.search(h + ' || ``', r) if '.' in h else r.get(h, '')
-            _lines = textwrap.wrap(str(v), width=maxwidth)
-            if len(_lines) > linec:
-                linec = len(_lines)
-            rlines[h] = _lines
+            values.insert(0, rc)
+        rlines = []
+        for h, v in zip(cols, values):
+            v = str(v)
+            if 0 < len(v) <= maxwidth and v.isprintable() and v.strip() == v:
+                _lines = (v,)
+            else:
+                _lines = tuple(textwrap.wrap(v, width=maxwidth))
+            rlines.append(_lines)
             if len(_lines) > 1:
                 colwidths[h] = maxwidth
             elif len(_lines) == 1 and len(_lines[0]) > colwidths[h]:
                 colwidths[h] = len(_lines[0])
-        for lc in range(linec):
-            _data.append({
-                h: rlines[h][lc] if lc < len(rlines[h]) else ''
-                for h in headers
-            })
-
-    def _print_line(d, _color=None, sep='|', hcolor={}):
-        _line = (' ' + sep + ' ').join(
-            str(
-                hcolor[h](d[h]) if h in hcolor else
-                _color(d[h]) if _color else d[h]
-            ).ljust(
-                colwidths[h] + (
-                    len(hcolor[h]('')) if h in hcolor else
-                    len(_color('')) if _color else 0
-                )
-            )
-            for h in headers
-        )
-        print(_line)
+        for lc in range(max((len(_lines) for _lines in rlines), default=0)):
+            _data.append(tuple(
+                _lines[lc] if lc < len(_lines) else '' for _lines in rlines
+            ))
 
+    def _styles(_color=None, hcolor={}):
+        styles = []
+        for h in cols:
+            _style = hcolor.get(h, _color)
+            styles.append((
+                _style,
+                colwidths[h] + (_ANSI_LEN[_style] if _style else 0)
+            ))
+        return styles
+
+    def _print_line(d, styles, sep=_BAR):
+        sys.stdout.write(sep.join([
+            (_style(v) if _style else v).ljust(width)
+            for v, (_style, width) in zip(d, styles)
+        ]))
+        sys.stdout.write('\n')
+
+    _print_line(tuple(cols), _styles(color.bold), _BAR)
     _print_line(
-        {h: h for h in headers}, color.bold, color.blue('|')
-    )
-    _print_line(
-        {h: '-' * colwidths[h] for h in headers},
-        color.blue, color.blue('+')
+        tuple('-' * colwidths[h] for h in cols), _styles(color.blue), _PLUS
     )
+    styles = _styles(hcolor={' ': color.bold})
     for r in _data:
-        _print_line(r, sep=color.blue('|'), hcolor={
-            ' ': color.bold
-        })
-    if dumpfile is not None:
-        dumppath = os.path.join(get_temp_basedir(), dumpfile)
-        with open(dumppath, 'w') as fh:
-            fh.write(dumpdata)
+        _print_line(r, styles)
+    sys.stdout.flush()
+    if dumppath is not None:
         print('written %s' % dumppath)
 
 
@@ -372,6 +566,10 @@ if __name__ == "__main__":
     parser.add_argument(
         '-t', '--transform', help='transform response using jmespath'
     )
+    parser.add_argument(
+        '--pretty', action='store_true',
+        help='indent json output (default when stdout is a terminal)'
+    )
     parser.add_argument('--debug', action='store_true')
     parser.add_argument('--no-cache', action='store_true')
     args = parser.parse_args()
@@ -385,7 +583,7 @@ if __name__ == "__main__":
     transform = args.transform
     headers = {}
     if args.debug is True:
-        os.environ['TMC_DEBUG'] = 'TRUE'
+        DEBUG = True
 
     if args.no_cache is True:
         os.environ['TMC_NO_CACHE'] = 'TRUE'
@@ -421,5 +619,12 @@ if __name__ == "__main__":
         )
         if args.headers is not None:
             print_table(list(headers.keys()), data)
+        elif args.pretty is True or sys.stdout.isatty():
+            print(dumps(data, indent=True).decode())
+        elif isinstance(data, list):
+            # one compact document per line (ndjson) for piping into jq etc
+            for item in data:
+                sys.stdout.write(dumps(item).decode())
+                sys.stdout.write('\n')
         else:
-            print(json.dumps(data, indent=2))
+            print(dumps(data).decode())